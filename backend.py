@@ -1,19 +1,224 @@
 # backend_fixed_fonts.py
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import FileResponse, JSONResponse
+import time
+STARTUP_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from ultralytics import YOLO
+from fastapi.concurrency import run_in_threadpool
 import cv2
 import numpy as np
 import json
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from pathlib import Path
 import uuid
 import shutil
-import tempfile
+from typing import Optional
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+import hashlib
+import threading
+import importlib
+from contextlib import asynccontextmanager
+
+# Модели загружаются в фоне: loading -> ready | failed
+MODEL_PATH = "runs/detect/runs/train/skateboarder_detection_m/weights/best.pt"
+MODELS_CONFIG = os.environ.get("MODELS_CONFIG", "models.json")
+# Каталог, из которого разрешена горячая замена весов
+WEIGHTS_DIR = os.environ.get("WEIGHTS_DIR", "runs")
+WARMUP_RUNS = int(os.environ.get("WARMUP_RUNS", 2))
+model_state = {
+    'status': 'loading',
+    'errors': {},
+    # import_app - fastapi, cv2, numpy и прочие импорты модуля
+    'timings': {'import_app': round(time.perf_counter() - STARTUP_STARTED, 3)}
+}
 
-app = FastAPI(title="Skateboard Detection API", version="2.1.0")
+def timed_import(name: str):
+    """Импорт модуля с замером времени"""
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    model_state['timings'][f"import_{name}"] = round(time.perf_counter() - started, 3)
+    return module
+
+def warm_up(loaded) -> int:
+    """Прогрев модели на пустом кадре: первый инференс инициализирует torch и выбирает ядра"""
+    imgsz = loaded.overrides.get('imgsz', 640)
+    if isinstance(imgsz, (list, tuple)):
+        imgsz = max(imgsz)
+    
+    dummy = np.zeros((imgsz, imgsz, 3), dtype=np.uint8)
+    for _ in range(WARMUP_RUNS):
+        loaded(dummy, conf=0.3, imgsz=imgsz, verbose=False)
+    return imgsz
+
+class ModelRegistry:
+    """Именованные варианты модели с атомарной заменой и выбором по нагрузке
+    
+    Варианты перечисляются в models.json от самого точного к самому быстрому:
+    {"variants": {"m": {"path": "...", "max_queue": 2}, "n": {"path": "..."}}}
+    Запрос без явного выбора получает первый готовый вариант, у которого
+    текущая очередь меньше max_queue (без max_queue - без ограничения).
+    """
+    
+    def __init__(self, config_path: str):
+        self.variants = OrderedDict()
+        if os.path.exists(config_path):
+            with open(config_path, 'r', encoding='utf-8') as f:
+                self.variants.update(json.load(f)['variants'])
+        else:
+            self.variants['m'] = {'path': MODEL_PATH}
+        
+        self.inflight = 0
+        # name -> загруженная модель; запрос держит ссылку на свою запись до конца обработки
+        self._models = {}
+        self._loading = set()
+        self._lock = threading.Lock()
+    
+    def load(self, name: str, path: Optional[str] = None):
+        """Загрузка и прогрев варианта с последующей атомарной заменой"""
+        with self._lock:
+            if name in self._loading:
+                raise RuntimeError(f"Вариант {name} уже загружается")
+            self._loading.add(name)
+        
+        try:
+            path = path or self.variants[name]['path']
+            YOLO = importlib.import_module('ultralytics').YOLO
+            
+            started = time.perf_counter()
+            loaded = YOLO(path)
+            load_time = time.perf_counter() - started
+            
+            started = time.perf_counter()
+            imgsz = warm_up(loaded)
+            warmup_time = time.perf_counter() - started
+            
+            entry = {
+                'name': name,
+                'path': path,
+                'model': loaded,
+                'imgsz': imgsz,
+                'loaded_at': datetime.now().isoformat(),
+                'load_seconds': round(load_time, 3),
+                'warmup_seconds': round(warmup_time, 3),
+                'inflight': 0
+            }
+            # Замена одной операцией: уже идущие запросы дорабатывают на старой модели
+            with self._lock:
+                self.variants.setdefault(name, {})['path'] = path
+                self._models[name] = entry
+            print(f"✅ Модель {name} загружена: {path} (imgsz={imgsz}, классы: {loaded.names})")
+            return entry
+        finally:
+            with self._lock:
+                self._loading.discard(name)
+    
+    def is_loading(self, name: Optional[str] = None) -> bool:
+        return name in self._loading if name else bool(self._loading)
+    
+    def ready(self) -> list:
+        return [name for name in self.variants if name in self._models]
+    
+    def classes(self):
+        """Классы первого готового варианта"""
+        with self._lock:
+            ready = self.ready()
+            return self._models[ready[0]]['model'].names if ready else None
+    
+    def acquire(self, name: Optional[str] = None):
+        """Выбор варианта (явно или по нагрузке) и учет запроса в очереди"""
+        with self._lock:
+            if name:
+                if name not in self.variants:
+                    raise KeyError(name)
+                entry = self._models.get(name)
+            else:
+                entry = self._route()
+            
+            if entry is not None:
+                entry['inflight'] += 1
+                self.inflight += 1
+            return entry
+    
+    def release(self, entry: dict):
+        with self._lock:
+            entry['inflight'] -= 1
+            self.inflight -= 1
+    
+    def _route(self):
+        ready = self.ready()
+        for name in ready:
+            max_queue = self.variants[name].get('max_queue')
+            if max_queue is None or self.inflight < max_queue:
+                return self._models[name]
+        # Все варианты перегружены - берем самый быстрый
+        return self._models[ready[-1]] if ready else None
+    
+    def describe(self) -> list:
+        with self._lock:
+            result = []
+            for name, variant in self.variants.items():
+                entry = self._models.get(name)
+                result.append({
+                    'name': name,
+                    'path': entry['path'] if entry else variant.get('path'),
+                    'max_queue': variant.get('max_queue'),
+                    'status': 'loading' if name in self._loading else ('ready' if entry else 'not_loaded'),
+                    'classes': entry['model'].names if entry else None,
+                    'imgsz': entry['imgsz'] if entry else None,
+                    'loaded_at': entry['loaded_at'] if entry else None,
+                    'inflight': entry['inflight'] if entry else 0
+                })
+            return result
+
+model_registry = ModelRegistry(MODELS_CONFIG)
+
+def load_models():
+    """Загрузка и прогрев всех вариантов модели (выполняется в отдельном потоке)"""
+    timings = model_state['timings']
+    try:
+        # torch отдельно, чтобы видеть его вклад в импорт ultralytics
+        timed_import('torch')
+        timed_import('ultralytics')
+    except Exception as e:
+        print(f"❌ Ошибка импорта ultralytics: {e}")
+        model_state['errors']['import'] = str(e)
+    
+    for name in list(model_registry.variants):
+        try:
+            entry = model_registry.load(name)
+            timings[f"load_weights_{name}"] = entry['load_seconds']
+            timings[f"warmup_{name}"] = entry['warmup_seconds']
+            # Готовы обслуживать запросы, как только прогрет первый вариант
+            model_state['status'] = 'ready'
+        except Exception as e:
+            print(f"❌ Ошибка загрузки модели {name}: {e}")
+            model_state['errors'][name] = str(e)
+    
+    if not model_registry.ready():
+        model_state['status'] = 'failed'
+    else:
+        resume_analyses()
+    
+    # reportlab нужен только для отчетов - подгружаем заранее, чтобы не платить на первом запросе
+    try:
+        timed_import('reportlab.platypus')
+        timed_import('reportlab.pdfbase.ttfonts')
+    except Exception as e:
+        print(f"⚠️  reportlab недоступен: {e}")
+    
+    timings['startup_total'] = round(time.perf_counter() - STARTUP_STARTED, 3)
+    print(f"⏱️  Время старта: {timings}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Не блокируем старт сервера: liveness отвечает сразу, readiness - после прогрева
+    threading.Thread(target=load_models, name="model-loader", daemon=True).start()
+    yield
+
+app = FastAPI(title="Skateboard Detection API", version="2.1.0", lifespan=lifespan)
 
 # Включаем CORS
 app.add_middleware(
@@ -24,48 +229,322 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Загружаем модель
-MODEL_PATH = "runs/detect/runs/train/skateboarder_detection_m/weights/best.pt"
-try:
-    model = YOLO(MODEL_PATH)
-    print(f"✅ Модель загружена: {MODEL_PATH}")
-    print(f"📋 Классы: {model.names}")
-except Exception as e:
-    print(f"❌ Ошибка загрузки модели: {e}")
-    model = None
-
 # Папки для хранения
 UPLOAD_DIR = "uploads"
 REPORTS_DIR = "reports"
+CHECKPOINTS_DIR = "checkpoints"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(REPORTS_DIR, exist_ok=True)
+os.makedirs(CHECKPOINTS_DIR, exist_ok=True)
+
+# Длина анализа (0 - все видео) и период контрольных точек
+ANALYSIS_MAX_SECONDS = float(os.environ.get("ANALYSIS_MAX_SECONDS", 5))
+CHECKPOINT_INTERVAL_SECONDS = float(os.environ.get("CHECKPOINT_INTERVAL_SECONDS", 30))
+# Сколько хранить результаты завершенных и неудачных анализов для /api/analyses/{id}
+CHECKPOINTS_RETENTION_HOURS = float(os.environ.get("CHECKPOINTS_RETENTION_HOURS", 24))
+# Сколько раз продолжать анализ после падения процесса
+RESUME_MAX_ATTEMPTS = int(os.environ.get("RESUME_MAX_ATTEMPTS", 3))
+
+# Декодер видео: auto (PyAV, если установлен) / pyav / opencv
+VIDEO_DECODER = os.environ.get("VIDEO_DECODER", "auto")
+DECODER_THREADS = int(os.environ.get("DECODER_THREADS", 0))
+DECODE_MAX_WIDTH = int(os.environ.get("DECODE_MAX_WIDTH", 1920))
+
+# Плиточный инференс для мелких объектов: auto (по степени сжатия кадра) / always / off
+TILING_MODE = os.environ.get("TILING_MODE", "auto")
+TILING_MODES = ('auto', 'always', 'off')
+TILING_MIN_DOWNSCALE = float(os.environ.get("TILING_MIN_DOWNSCALE", 4.0))
+TILING_DECODE_MAX_WIDTH = int(os.environ.get("TILING_DECODE_MAX_WIDTH", 2560))
+TILE_OVERLAP = float(os.environ.get("TILE_OVERLAP", 0.2))
+TILE_NMS_IOU = float(os.environ.get("TILE_NMS_IOU", 0.5))
+TILE_NMS_IOS = float(os.environ.get("TILE_NMS_IOS", 0.7))
+TILE_SEAM_MARGIN = float(os.environ.get("TILE_SEAM_MARGIN", 4))
+
+# Квоты хранилища отчетов
+REPORTS_MAX_AGE_DAYS = float(os.environ.get("REPORTS_MAX_AGE_DAYS", 30))
+REPORTS_MAX_TOTAL_MB = float(os.environ.get("REPORTS_MAX_TOTAL_MB", 500))
+REPORTS_MAX_COUNT = int(os.environ.get("REPORTS_MAX_COUNT", 1000))
+REPORTS_CACHE_MAX_AGE = int(os.environ.get("REPORTS_CACHE_MAX_AGE", 86400))
 
 # История обработок
 HISTORY_FILE = "processing_history.json"
+HISTORY_SORT_FIELDS = ['timestamp', 'filename', 'violations_count', 'total_objects', 'model']
 
-def save_to_history(data: dict):
-    """Сохранение в историю"""
-    history = []
+# Архив детекций (Parquet, партиции date=YYYY-MM-DD/hour=HH)
+DETECTIONS_DIR = "detections"
+ANALYTICS_GROUP_BY = ['date', 'hour', 'weekday', 'camera', 'source', 'class_name']
+
+class ReportStore:
+    """Индекс отчетов с ограничением по возрасту, размеру и количеству (LRU вытеснение)"""
+    
+    MEDIA_TYPES = {'.pdf': 'application/pdf', '.txt': 'text/plain'}
+    
+    def __init__(self, directory: str, max_age_days: float, max_total_mb: float, max_count: int):
+        self.directory = directory
+        self.max_age = max_age_days * 86400
+        self.max_total_bytes = int(max_total_mb * 1024 * 1024)
+        self.max_count = max_count
+        self.total_bytes = 0
+        # report_id -> запись; порядок = от давно не использованных к недавним
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._scan()
+    
+    def _make_entry(self, path: str, stat: os.stat_result):
+        ext = Path(path).suffix.lower()
+        return {
+            'path': path,
+            'media_type': self.MEDIA_TYPES[ext],
+            'ext': ext,
+            'stat': stat,
+            'etag': '"' + hashlib.md5(f"{stat.st_mtime_ns}-{stat.st_size}".encode()).hexdigest() + '"',
+            'last_modified': formatdate(stat.st_mtime, usegmt=True)
+        }
+    
+    def _scan(self):
+        """Однократное построение индекса по содержимому папки при старте"""
+        found = {}
+        with os.scandir(self.directory) as it:
+            for item in it:
+                name, ext = os.path.splitext(item.name)
+                if not item.is_file() or not name.startswith('report_') or ext not in self.MEDIA_TYPES:
+                    continue
+                report_id = name[len('report_'):]
+                # PDF приоритетнее текстового варианта с тем же id, проигравший файл удаляем
+                if report_id in found:
+                    if found[report_id][0].endswith('.pdf'):
+                        self._unlink(item.path)
+                        continue
+                    self._unlink(found[report_id][0])
+                found[report_id] = (item.path, item.stat())
+        
+        with self._lock:
+            for report_id, (path, stat) in sorted(found.items(), key=lambda x: x[1][1].st_mtime):
+                self._put(report_id, self._make_entry(path, stat))
+            self._evict()
+        print(f"📚 В индексе отчетов: {len(self._entries)} ({self.total_bytes / 1024 / 1024:.1f} MB)")
+    
+    def _put(self, report_id: str, entry: dict):
+        old = self._entries.pop(report_id, None)
+        if old is not None:
+            self.total_bytes -= old['stat'].st_size
+            if old['path'] != entry['path']:
+                self._unlink(old['path'])
+        self._entries[report_id] = entry
+        self.total_bytes += entry['stat'].st_size
+    
+    def _unlink(self, path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️  Не удалось удалить отчет {path}: {e}")
+    
+    def _remove(self, report_id: str):
+        entry = self._entries.pop(report_id)
+        self.total_bytes -= entry['stat'].st_size
+        self._unlink(entry['path'])
+    
+    def _evict(self):
+        """Удаление просроченных отчетов, затем давно не использованных сверх квот"""
+        if self.max_age > 0:
+            deadline = time.time() - self.max_age
+            for report_id in [rid for rid, e in self._entries.items() if e['stat'].st_mtime < deadline]:
+                self._remove(report_id)
+        
+        while self._entries and (
+            (self.max_count > 0 and len(self._entries) > self.max_count)
+            or (self.max_total_bytes > 0 and self.total_bytes > self.max_total_bytes)
+        ):
+            report_id = next(iter(self._entries))
+            print(f"🧹 Вытесняю отчет: {report_id}")
+            self._remove(report_id)
+    
+    def add(self, report_id: str, path: str):
+        """Регистрация только что созданного отчета"""
+        entry = self._make_entry(path, os.stat(path))
+        with self._lock:
+            self._put(report_id, entry)
+            self._evict()
+    
+    def get(self, report_id: str):
+        """Поиск отчета по индексу без обращения к файловой системе"""
+        with self._lock:
+            entry = self._entries.get(report_id)
+            if entry is None:
+                return None
+            if self.max_age > 0 and entry['stat'].st_mtime < time.time() - self.max_age:
+                self._remove(report_id)
+                return None
+            self._entries.move_to_end(report_id)
+            return entry
+
+def is_not_modified(request: Request, entry: dict) -> bool:
+    """Проверка условных заголовков If-None-Match / If-Modified-Since"""
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or any(tag.removeprefix('W/') == entry['etag'] for tag in tags)
+    
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(entry['stat'].st_mtime) <= since
+    
+    return False
+
+_index_started = time.perf_counter()
+report_store = ReportStore(REPORTS_DIR, REPORTS_MAX_AGE_DAYS, REPORTS_MAX_TOTAL_MB, REPORTS_MAX_COUNT)
+model_state['timings']['report_index'] = round(time.perf_counter() - _index_started, 3)
+
+# Анализы идут параллельно в пуле потоков - запись истории под блокировкой
+history_lock = threading.Lock()
+
+def load_history() -> list:
+    """Чтение истории обработок"""
     if os.path.exists(HISTORY_FILE):
         try:
-            with open(HISTORY_FILE, 'r') as f:
-                history = json.load(f)
+            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
         except:
-            history = []
-    
-    history.append({
-        'id': str(uuid.uuid4()),
-        'timestamp': datetime.now().isoformat(),
-        'filename': data.get('filename', 'unknown'),
-        'violations_count': data.get('violations_count', 0),
-        'total_objects': data.get('total_objects', 0)
-    })
-    
-    with open(HISTORY_FILE, 'w') as f:
-        json.dump(history, f, indent=2, ensure_ascii=False)
+            return []
+    return []
+
+def save_to_history(data: dict):
+    """Сохранение в историю"""
+    with history_lock:
+        history = load_history()
+        history.append({
+            'id': str(uuid.uuid4()),
+            'timestamp': datetime.now().isoformat(),
+            'filename': data.get('filename', 'unknown'),
+            'violations_count': data.get('violations_count', 0),
+            'total_objects': data.get('total_objects', 0),
+            'model': data.get('model'),
+            'analysis_id': data.get('analysis_id'),
+            'report_id': data.get('report_id')
+        })
+        
+        # Через временный файл: параллельное чтение никогда не видит недописанный JSON
+        tmp_path = HISTORY_FILE + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(history, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, HISTORY_FILE)
     
     return history
 
+def detections_staging_dir(analysis_id: str) -> str:
+    """Порции детекций незавершенного анализа хранятся рядом с его контрольной точкой"""
+    return os.path.join(CHECKPOINTS_DIR, f"{analysis_id}_detections")
+
+def stage_detections(analysis_id: str, rows: list, chunk: int = 0):
+    """Запись порции детекций во временный файл анализа (при повторе перезаписывается)"""
+    if not rows:
+        return 0
+    
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    table = pa.Table.from_pylist(rows, schema=pa.schema([
+        ('analysis_id', pa.string()),
+        ('camera', pa.string()),
+        ('source', pa.string()),
+        ('detected_at', pa.timestamp('us')),
+        ('date', pa.string()),
+        ('hour', pa.int8()),
+        ('weekday', pa.int8()),
+        ('frame', pa.int32()),
+        ('video_timestamp', pa.float32()),
+        ('class_name', pa.string()),
+        ('confidence', pa.float32()),
+        ('x1', pa.float32()),
+        ('y1', pa.float32()),
+        ('x2', pa.float32()),
+        ('y2', pa.float32()),
+        ('is_violation', pa.bool_()),
+    ]))
+    
+    staging_dir = detections_staging_dir(analysis_id)
+    os.makedirs(staging_dir, exist_ok=True)
+    pq.write_table(table, os.path.join(staging_dir, f"chunk-{chunk}.parquet"))
+    return len(rows)
+
+def archive_detections(analysis_id: str):
+    """Перенос детекций завершенного анализа в партиционированный Parquet датасет
+    
+    Порции объединяются, и в каждую партицию date/hour анализ пишет один файл,
+    чтобы аналитика не сканировала тысячи мелких файлов.
+    """
+    staging_dir = detections_staging_dir(analysis_id)
+    chunks = sorted(Path(staging_dir).glob('chunk-*.parquet')) if os.path.isdir(staging_dir) else []
+    if not chunks:
+        discard_staged_detections(analysis_id)
+        return 0
+    
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    table = pa.concat_tables([pq.read_table(chunk) for chunk in chunks])
+    # Имя файла зависит только от анализа - повторный перенос после падения перезапишет его
+    pq.write_to_dataset(
+        table,
+        root_path=DETECTIONS_DIR,
+        partition_cols=['date', 'hour'],
+        basename_template=f"part-{analysis_id}-{{i}}.parquet",
+        existing_data_behavior='overwrite_or_ignore',
+        compression='zstd'
+    )
+    discard_staged_detections(analysis_id)
+    print(f"🗄️  В архив записано детекций: {table.num_rows}")
+    return table.num_rows
+
+def discard_staged_detections(analysis_id: str):
+    shutil.rmtree(detections_staging_dir(analysis_id), ignore_errors=True)
+
+def query_detections(group_by: list, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                     camera: Optional[str] = None, class_name: Optional[str] = None,
+                     violations_only: bool = False):
+    """Агрегация архива детекций (фильтры проталкиваются в сканирование Parquet)"""
+    if not os.path.isdir(DETECTIONS_DIR) or not any(Path(DETECTIONS_DIR).rglob("*.parquet")):
+        return []
+    
+    import polars as pl
+    
+    lf = pl.scan_parquet(
+        os.path.join(DETECTIONS_DIR, "**", "*.parquet"),
+        hive_partitioning=True,
+        hive_schema={'date': pl.String, 'hour': pl.Int8}
+    )
+    
+    # Фильтры по date/hour отсекают целые партиции, остальные - группы строк
+    if date_from:
+        lf = lf.filter(pl.col('date') >= date_from)
+    if date_to:
+        lf = lf.filter(pl.col('date') <= date_to)
+    if camera:
+        lf = lf.filter(pl.col('camera') == camera)
+    if class_name:
+        lf = lf.filter(pl.col('class_name') == class_name)
+    if violations_only:
+        lf = lf.filter(pl.col('is_violation'))
+    
+    result = (
+        lf.group_by(group_by)
+        .agg(
+            pl.len().alias('detections'),
+            pl.col('is_violation').sum().alias('violations'),
+            pl.col('confidence').mean().alias('avg_confidence'),
+            pl.col('analysis_id').n_unique().alias('analyses'),
+        )
+        .sort(group_by)
+        .collect()
+    )
+    return result.to_dicts()
+
 def generate_pdf_with_russian(statistics: dict, output_path: str):
     """Генерация PDF с поддержкой русских шрифтов"""
     try:
@@ -356,11 +835,685 @@ def generate_pdf_with_russian(statistics: dict, output_path: str):
         except:
             return False
 
+class VideoDecoder:
+    """Базовый декодер: метаданные потока и итерация по кадрам с прореживанием
+    
+    Кадры отдаются в BGR, уменьшенными до DECODE_MAX_WIDTH по ширине (0 - без уменьшения);
+    координаты на уменьшенном кадре переводятся в исходные делением на scale.
+    """
+    
+    name = 'base'
+    
+    def __init__(self, path: str, max_width: int = 0):
+        self.path = path
+        self.max_width = max_width
+        self.fps = 30.0
+        self.total_frames = 0
+        self.width = 0
+        self.height = 0
+        self.codec = None
+    
+    def _init_output_size(self):
+        if self.max_width and self.width > self.max_width:
+            self.out_width = self.max_width - self.max_width % 2
+            self.out_height = int(round(self.height * self.out_width / self.width / 2)) * 2
+        else:
+            self.out_width, self.out_height = self.width, self.height
+        self.scale = self.out_width / self.width if self.width else 1.0
+    
+    @property
+    def info(self) -> dict:
+        return {
+            'decoder': self.name,
+            'codec': self.codec,
+            'fps': self.fps,
+            'total_frames': self.total_frames,
+            'width': self.width,
+            'height': self.height,
+            'decoded_resolution': f"{self.out_width}x{self.out_height}"
+        }
+    
+    def frames(self, start: int = 0, stop: Optional[int] = None, step: int = 1):
+        """Кадры (index, bgr) с index в [start, stop) и index % step == 0"""
+        raise NotImplementedError
+    
+    def close(self):
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+class OpenCVDecoder(VideoDecoder):
+    """Декодер на cv2.VideoCapture (запасной вариант)"""
+    
+    name = 'opencv'
+    
+    def __init__(self, path: str, max_width: int = 0):
+        super().__init__(path, max_width)
+        self._cap = cv2.VideoCapture(path)
+        if not self._cap.isOpened():
+            raise RuntimeError(f"OpenCV не может открыть видео: {path}")
+        
+        self.fps = self._cap.get(cv2.CAP_PROP_FPS) or 30.0
+        self.total_frames = int(self._cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.width = int(self._cap.get(cv2.CAP_PROP_FRAME_WIDTH)) or 1280
+        self.height = int(self._cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or 720
+        fourcc = int(self._cap.get(cv2.CAP_PROP_FOURCC))
+        self.codec = ''.join(chr((fourcc >> 8 * k) & 0xFF) for k in range(4)).strip() or None
+        self._init_output_size()
+    
+    def frames(self, start: int = 0, stop: Optional[int] = None, step: int = 1):
+        if start > 0:
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        
+        index = start
+        while stop is None or index < stop:
+            if index % step == 0:
+                ret, frame = self._cap.read()
+                if not ret:
+                    break
+                if self.scale != 1.0:
+                    frame = cv2.resize(frame, (self.out_width, self.out_height), interpolation=cv2.INTER_AREA)
+                yield index, frame
+            elif not self._cap.grab():
+                # grab без retrieve пропускает кадр без преобразования цвета
+                break
+            index += 1
+    
+    def close(self):
+        self._cap.release()
+
+class PyAVDecoder(VideoDecoder):
+    """Декодер на PyAV/FFmpeg: многопоточное декодирование, поиск по ключевым кадрам"""
+    
+    name = 'pyav'
+    
+    def __init__(self, path: str, max_width: int = 0, threads: int = 0):
+        super().__init__(path, max_width)
+        import av
+        
+        self._container = av.open(path)
+        if not self._container.streams.video:
+            self._container.close()
+            raise RuntimeError(f"В файле нет видеопотока: {path}")
+        
+        stream = self._container.streams.video[0]
+        # Кадровая и слайсовая многопоточность FFmpeg; 0 - по числу ядер
+        stream.thread_type = 'AUTO'
+        stream.codec_context.thread_count = threads
+        self._stream = stream
+        
+        rate = stream.average_rate or stream.guessed_rate
+        self.fps = float(rate) if rate else 30.0
+        self.width = stream.codec_context.width
+        self.height = stream.codec_context.height
+        self.codec = stream.codec_context.name
+        self._time_base = float(stream.time_base)
+        self._start_pts = stream.start_time or 0
+        
+        # Число кадров из заголовка, иначе по длительности потока/контейнера
+        if stream.frames:
+            self.total_frames = stream.frames
+        elif stream.duration:
+            self.total_frames = int(stream.duration * self._time_base * self.fps)
+        elif self._container.duration:
+            self.total_frames = int(self._container.duration / av.time_base * self.fps)
+        self._init_output_size()
+    
+    def _frame_index(self, frame, expected: int) -> int:
+        if frame.pts is None:
+            return expected
+        return int(round((frame.pts - self._start_pts) * self._time_base * self.fps))
+    
+    def frames(self, start: int = 0, stop: Optional[int] = None, step: int = 1):
+        if start > 0:
+            # Переход на ближайший предшествующий ключевой кадр, остаток докручиваем декодированием
+            target = self._start_pts + int(start / self.fps / self._time_base)
+            self._container.seek(target, stream=self._stream, backward=True, any_frame=False)
+        
+        expected = start
+        for frame in self._container.decode(self._stream):
+            index = self._frame_index(frame, expected)
+            expected = index + 1
+            if index < start:
+                continue
+            if stop is not None and index >= stop:
+                break
+            # Пропущенные кадры не конвертируются в BGR
+            if index % step == 0:
+                yield index, frame.to_ndarray(format='bgr24', width=self.out_width, height=self.out_height)
+    
+    def close(self):
+        self._container.close()
+
+def open_decoder(path: str, max_width: int = DECODE_MAX_WIDTH) -> VideoDecoder:
+    """Выбор декодера по VIDEO_DECODER (auto/pyav/opencv) с откатом на OpenCV"""
+    if VIDEO_DECODER in ('auto', 'pyav'):
+        try:
+            return PyAVDecoder(path, max_width, DECODER_THREADS)
+        except ImportError as e:
+            if VIDEO_DECODER == 'pyav':
+                raise
+            print(f"⚠️  PyAV не установлен, использую OpenCV (однопоточное декодирование): {e}")
+        except Exception as e:
+            print(f"⚠️  PyAV не смог открыть видео, использую OpenCV: {e}")
+    return OpenCVDecoder(path, max_width)
+
+def tile_origins(length: int, tile: int, stride: int) -> list:
+    """Начала плиток вдоль одной оси; последняя плитка прижата к краю кадра"""
+    if length <= tile:
+        return [0]
+    origins = list(range(0, length - tile, stride))
+    origins.append(length - tile)
+    return origins
+
+def needs_tiling(width: int, height: int, imgsz: int, mode: str) -> bool:
+    """Плитки нужны, если при сжатии кадра до imgsz мелкие объекты теряются"""
+    if mode == 'always':
+        return max(width, height) > imgsz
+    if mode == 'auto':
+        return max(width, height) / imgsz >= TILING_MIN_DOWNSCALE
+    return False
+
+def merge_detections(boxes: np.ndarray, scores: np.ndarray, classes: np.ndarray,
+                     sources: np.ndarray, on_seam: np.ndarray) -> list:
+    """NMS по всем плиткам с учетом класса
+    
+    Для рамок из разных элементов батча, где меньшая рамка касается стыка плиток,
+    подавляется и доля пересечения от меньшей рамки (IoS): обрезанная стыком рамка
+    лежит внутри полной, и IoU между ними бывает мал. Остальные пары - обычный IoU,
+    чтобы не терять отдельные объекты в толпе.
+    """
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        
+        w = np.clip(np.minimum(boxes[i, 2], boxes[rest, 2]) - np.maximum(boxes[i, 0], boxes[rest, 0]), 0, None)
+        h = np.clip(np.minimum(boxes[i, 3], boxes[rest, 3]) - np.maximum(boxes[i, 1], boxes[rest, 1]), 0, None)
+        inter = w * h
+        iou = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-9)
+        ios = inter / np.maximum(np.minimum(areas[i], areas[rest]), 1e-9)
+        smaller_on_seam = np.where(areas[rest] < areas[i], on_seam[rest], on_seam[i])
+        truncated = (sources[rest] != sources[i]) & smaller_on_seam & (ios > TILE_NMS_IOS)
+        
+        suppressed = (classes[rest] == classes[i]) & ((iou > TILE_NMS_IOU) | truncated)
+        order = rest[~suppressed]
+    return keep
+
+def seam_mask(boxes: np.ndarray, x0: int, y0: int, tile_w: int, tile_h: int, width: int, height: int) -> np.ndarray:
+    """Рамки плитки, касающиеся ее внутренних краев (стыков), а не границ кадра"""
+    margin = TILE_SEAM_MARGIN
+    mask = np.zeros(len(boxes), dtype=bool)
+    if x0 > 0:
+        mask |= boxes[:, 0] <= x0 + margin
+    if y0 > 0:
+        mask |= boxes[:, 1] <= y0 + margin
+    if x0 + tile_w < width:
+        mask |= boxes[:, 2] >= x0 + tile_w - margin
+    if y0 + tile_h < height:
+        mask |= boxes[:, 3] >= y0 + tile_h - margin
+    return mask
+
+def detect(model, frame: np.ndarray, imgsz: int, tiled: bool):
+    """Детекции кадра [(class_id, confidence, (x1, y1, x2, y2))], целиком или плитками"""
+    if not tiled:
+        results = model(frame, conf=0.3, verbose=False)
+        boxes = results[0].boxes
+        return [
+            (int(c), float(s), tuple(float(v) for v in b))
+            for b, s, c in zip(boxes.xyxy.tolist(), boxes.conf.tolist(), boxes.cls.tolist())
+        ]
+    
+    # Весь кадр (крупные объекты) и перекрывающиеся плитки imgsz одним батчем
+    height, width = frame.shape[:2]
+    stride = max(1, int(imgsz * (1 - TILE_OVERLAP)))
+    origins = [(x0, y0) for y0 in tile_origins(height, imgsz, stride) for x0 in tile_origins(width, imgsz, stride)]
+    batch = [frame] + [frame[y0:y0 + imgsz, x0:x0 + imgsz] for x0, y0 in origins]
+    results = model(batch, conf=0.3, imgsz=imgsz, verbose=False)
+    
+    boxes, scores, classes, sources, on_seam = [], [], [], [], []
+    for source, ((x0, y0), result) in enumerate(zip([(0, 0)] + origins, results)):
+        if len(result.boxes) == 0:
+            continue
+        tile_boxes = result.boxes.xyxy.cpu().numpy() + np.array([x0, y0, x0, y0], dtype=np.float32)
+        boxes.append(tile_boxes)
+        scores.append(result.boxes.conf.cpu().numpy())
+        classes.append(result.boxes.cls.cpu().numpy())
+        sources.append(np.full(len(tile_boxes), source))
+        if source == 0:
+            # Полный кадр стыков не имеет
+            on_seam.append(np.zeros(len(tile_boxes), dtype=bool))
+        else:
+            tile_h, tile_w = batch[source].shape[:2]
+            on_seam.append(seam_mask(tile_boxes, x0, y0, tile_w, tile_h, width, height))
+    
+    if not boxes:
+        return []
+    boxes, scores, classes = np.concatenate(boxes), np.concatenate(scores), np.concatenate(classes)
+    keep = merge_detections(boxes, scores, classes, np.concatenate(sources), np.concatenate(on_seam))
+    return [
+        (int(classes[i]), float(scores[i]), tuple(float(v) for v in boxes[i]))
+        for i in keep
+    ]
+
+def save_checkpoint(job: dict):
+    """Атомарная запись состояния анализа (через временный файл)"""
+    path = os.path.join(CHECKPOINTS_DIR, f"{job['analysis_id']}.json")
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def load_job(analysis_id: str):
+    path = os.path.join(CHECKPOINTS_DIR, f"{analysis_id}.json")
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def new_job(analysis_id: str, upload_path: str, filename: str, camera: Optional[str], model_name: str,
+            tiling: str = TILING_MODE, recorded_at: Optional[datetime] = None):
+    """Начальное состояние анализа для контрольных точек"""
+    return {
+        'analysis_id': analysis_id,
+        'report_id': str(uuid.uuid4()),
+        'status': 'running',
+        'upload_path': upload_path,
+        'filename': filename,
+        'camera': camera,
+        'model_name': model_name,
+        'tiling': tiling,
+        'analysis_started': datetime.now().isoformat(),
+        'recorded_at': recorded_at.isoformat() if recorded_at else None,
+        'video': None,
+        # Накопители: следующий кадр, номер порции архива и частичная статистика
+        'next_frame': 0,
+        'chunk': 0,
+        'total_detections': 0,
+        'tiled_frames': 0,
+        'by_class': {},
+        'violations': [],
+        'violations_count': 0,
+        'result': None,
+        'error': None
+    }
+
+def analyze_video(job: dict, variant: dict):
+    """Анализ видео с контрольными точками; продолжает с job['next_frame']"""
+    model = variant['model']
+    analysis_id = job['analysis_id']
+    # Время детекций отсчитываем от начала записи, если клиент его передал
+    base_time = datetime.fromisoformat(job.get('recorded_at') or job['analysis_started'])
+    by_class = job['by_class']
+    violations = job['violations']
+    tiling = job.get('tiling', TILING_MODE)
+    job.setdefault('tiled_frames', 0)
+    detection_rows = []
+    
+    decoder = open_decoder(job['upload_path'])
+    tiled = needs_tiling(decoder.width, decoder.height, variant['imgsz'], tiling)
+    if tiled and decoder.scale < 1.0:
+        # Плиткам нужна детализация - декодируем крупнее обычного
+        decoder.close()
+        decoder = open_decoder(job['upload_path'], TILING_DECODE_MAX_WIDTH)
+    if job['video'] is None:
+        video = decoder.info
+        fps = video['fps']
+        total_frames = video['total_frames']
+        # ANALYSIS_MAX_SECONDS = 0 - анализ всего видео
+        if total_frames > 0:
+            frames_to_analyze = min(int(fps * ANALYSIS_MAX_SECONDS), total_frames) if ANALYSIS_MAX_SECONDS > 0 else total_frames
+        elif ANALYSIS_MAX_SECONDS > 0:
+            frames_to_analyze = int(fps * ANALYSIS_MAX_SECONDS)
+        else:
+            frames_to_analyze = None
+        video['frames_to_analyze'] = frames_to_analyze
+        job['video'] = video
+    fps = job['video']['fps']
+    frames_to_analyze = job['video']['frames_to_analyze']
+    
+    start = job['next_frame']
+    if start > 0:
+        print(f"⏩ Продолжаю анализ {analysis_id} с кадра {start}")
+    print(f"🔍 Анализирую кадры {start}-{frames_to_analyze or 'конец'} ({decoder.name}, "
+          f"{decoder.out_width}x{decoder.out_height}) моделью {variant['name']}...")
+    
+    def checkpoint(next_frame: int):
+        # Сначала порция детекций, затем состояние: при повторе порция перезапишется тем же именем
+        try:
+            stage_detections(analysis_id, detection_rows, job['chunk'])
+        except Exception as e:
+            print(f"⚠️  Не удалось сохранить порцию детекций: {e}")
+        detection_rows.clear()
+        job['chunk'] += 1
+        job['next_frame'] = next_frame
+        save_checkpoint(job)
+    
+    last_checkpoint = time.monotonic()
+    next_frame = start
+    try:
+        # Анализируем каждый 5-й кадр для скорости
+        for i, frame in decoder.frames(start, frames_to_analyze, step=5):
+            next_frame = i + 1
+            detections = detect(model, frame, variant['imgsz'], tiled)
+            if tiled:
+                job['tiled_frames'] += 1
+            
+            if detections:
+                job['total_detections'] += 1
+                
+                for class_id, confidence, box in detections:
+                    class_name = model.names.get(class_id, f"class_{class_id}")
+                    # Координаты в исходном разрешении видео
+                    x1, y1, x2, y2 = (v / decoder.scale for v in box)
+                    is_violation = class_name.lower() in ['skateboarder', 'skateboard', 'person']
+                    
+                    # Обновляем статистику по классам
+                    if class_name not in by_class:
+                        by_class[class_name] = {'count': 0, 'confidence_sum': 0.0}
+                    
+                    by_class[class_name]['count'] += 1
+                    by_class[class_name]['confidence_sum'] += confidence
+                    
+                    # Если скейтбордист - отмечаем как нарушение
+                    if is_violation:
+                        job['violations_count'] += 1
+                        if len(violations) < 50:  # Ограничиваем список
+                            violations.append({
+                                'frame': i,
+                                'timestamp': i / fps,
+                                'confidence': confidence
+                            })
+                    
+                    # Строка для архива детекций
+                    detected_at = base_time + timedelta(seconds=i / fps)
+                    detection_rows.append({
+                        'analysis_id': analysis_id,
+                        'camera': job['camera'] or 'default',
+                        'source': job['filename'],
+                        'detected_at': detected_at,
+                        'date': detected_at.strftime('%Y-%m-%d'),
+                        'hour': detected_at.hour,
+                        'weekday': detected_at.weekday(),
+                        'frame': i,
+                        'video_timestamp': i / fps,
+                        'class_name': class_name,
+                        'confidence': confidence,
+                        'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2,
+                        'is_violation': is_violation,
+                    })
+            
+            if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL_SECONDS:
+                checkpoint(i + 1)
+                last_checkpoint = time.monotonic()
+    finally:
+        decoder.close()
+    
+    # Длина неизвестна заранее - фиксируем фактическую
+    if frames_to_analyze is None:
+        frames_to_analyze = next_frame
+        job['video']['frames_to_analyze'] = frames_to_analyze
+    checkpoint(frames_to_analyze)
+    
+    # Рассчитываем среднюю уверенность для каждого класса
+    result_by_class = {
+        class_name: {
+            'count': stats['count'],
+            'avg_confidence': stats['confidence_sum'] / stats['count'] if stats['count'] else 0
+        }
+        for class_name, stats in by_class.items()
+    }
+    total_objects = sum(stats['count'] for stats in by_class.values())
+    
+    # Формируем статистику
+    video = job['video']
+    return {
+        'video_info': {
+            'filename': job['filename'],
+            'resolution': f"{video['width']}x{video['height']}",
+            'fps': fps,
+            'total_frames': video['total_frames'],
+            'duration_seconds': video['total_frames'] / fps if fps > 0 else 0
+        },
+        'detections': {
+            'total_frames_with_detections': job['total_detections'],
+            'total_objects_detected': total_objects,
+            'by_class': result_by_class,
+            'frames_with_violations': violations
+        },
+        'inference': {
+            'decoder': video.get('decoder'),
+            'tiling': tiling,
+            'tiled_frames': job['tiled_frames']
+        },
+        'summary': {
+            'violation_percentage': (job['violations_count'] / max(1, frames_to_analyze // 5)) * 100,
+            'avg_objects_per_frame': total_objects / max(1, frames_to_analyze // 5),
+            'most_common_class': max(by_class.items(), key=lambda x: x[1]['count'])[0] if by_class else 'Не обнаружено'
+        }
+    }
+
+def finish_analysis(job: Optional[dict], statistics: dict, report_id: str, model_name: Optional[str],
+                    analysis_id: Optional[str] = None):
+    """Отчет и история по готовой статистике"""
+    pdf_path = os.path.join(REPORTS_DIR, f"report_{report_id}.pdf")
+    
+    if generate_pdf_with_russian(statistics, pdf_path):
+        report_store.add(report_id, pdf_path)
+    else:
+        # doc.build мог оставить недописанный PDF - он не должен обслуживаться после перезапуска
+        if os.path.exists(pdf_path):
+            os.unlink(pdf_path)
+        txt_path = pdf_path.replace('.pdf', '.txt')
+        if os.path.exists(txt_path):
+            report_store.add(report_id, txt_path)
+    
+    # Сохраняем в историю
+    save_to_history({
+        'filename': statistics['video_info']['filename'],
+        'violations_count': len(statistics['detections']['frames_with_violations']),
+        'total_objects': statistics['detections']['total_objects_detected'],
+        'model': model_name,
+        'analysis_id': job['analysis_id'] if job is not None else analysis_id,
+        'report_id': report_id
+    })
+    
+    if job is not None:
+        job['status'] = 'done'
+        job['result'] = {'report_id': report_id, 'statistics': statistics}
+        save_checkpoint(job)
+        discard_upload(job)
+        prune_checkpoints()
+
+def discard_upload(job: dict):
+    """Удаление загрузки, когда анализ уже не будет продолжен"""
+    try:
+        os.unlink(job['upload_path'])
+    except:
+        pass
+
+def prune_checkpoints():
+    """Удаление завершенных и неудачных анализов старше CHECKPOINTS_RETENTION_HOURS"""
+    deadline = time.time() - CHECKPOINTS_RETENTION_HOURS * 3600
+    for item in Path(CHECKPOINTS_DIR).glob('*.json'):
+        try:
+            if item.stat().st_mtime >= deadline:
+                continue
+            with open(item, 'r', encoding='utf-8') as f:
+                status = json.load(f).get('status')
+            if status in ('done', 'failed'):
+                item.unlink()
+        except Exception as e:
+            print(f"⚠️  Не удалось проверить контрольную точку {item.name}: {e}")
+
+def run_analysis(job: dict, variant: dict):
+    """Полный цикл анализа: кадры с контрольными точками, отчет, история"""
+    try:
+        statistics = analyze_video(job, variant)
+        try:
+            archive_detections(job['analysis_id'])
+        except Exception as e:
+            print(f"⚠️  Не удалось записать детекции в архив: {e}")
+        statistics['model'] = {
+            'name': variant['name'],
+            'path': variant['path'],
+            'loaded_at': variant['loaded_at']
+        }
+        finish_analysis(job, statistics, job['report_id'], variant['name'])
+        return statistics
+    except Exception as e:
+        # Ошибка повторится и после перезапуска - не продолжаем такой анализ.
+        # Падение процесса сюда не доходит, и его контрольная точка остается 'running'
+        job['status'] = 'failed'
+        job['error'] = str(e)
+        save_checkpoint(job)
+        discard_upload(job)
+        discard_staged_detections(job['analysis_id'])
+        raise
+
+def resume_analyses():
+    """Продолжение анализов, прерванных падением или перезапуском (по одному в фоновом потоке)"""
+    prune_checkpoints()
+    jobs = []
+    for item in sorted(Path(CHECKPOINTS_DIR).glob('*.json')):
+        try:
+            with open(item, 'r', encoding='utf-8') as f:
+                job = json.load(f)
+        except Exception as e:
+            print(f"⚠️  Поврежденная контрольная точка {item.name}: {e}")
+            continue
+        if job.get('status') != 'running':
+            continue
+        if not os.path.exists(job['upload_path']):
+            print(f"⚠️  Нет загруженного файла для {job['analysis_id']}, пропускаю")
+            job['status'] = 'failed'
+            job['error'] = "Загруженный файл не найден"
+            save_checkpoint(job)
+            continue
+        
+        # Анализ, который сам роняет процесс (например, OOM), не должен перезапускаться бесконечно
+        job['attempts'] = job.get('attempts', 0) + 1
+        if job['attempts'] > RESUME_MAX_ATTEMPTS:
+            print(f"❌ Анализ {job['analysis_id']} прерывался {RESUME_MAX_ATTEMPTS} раз, отмечаю как неудачный")
+            job['status'] = 'failed'
+            job['error'] = f"Процесс падал при обработке {RESUME_MAX_ATTEMPTS} раз подряд"
+            save_checkpoint(job)
+            discard_upload(job)
+            continue
+        # Попытка засчитывается до запуска: при падении процесса счетчик уже сохранен
+        save_checkpoint(job)
+        jobs.append(job)
+    
+    if not jobs:
+        return
+    
+    def resume_all():
+        for job in jobs:
+            try:
+                variant = model_registry.acquire(job['model_name'])
+            except KeyError:
+                variant = None
+            if variant is None:
+                variant = model_registry.acquire()
+            if variant is None:
+                print(f"⚠️  Нет готовой модели для продолжения {job['analysis_id']}")
+                continue
+            
+            try:
+                run_analysis(job, variant)
+                print(f"✅ Анализ {job['analysis_id']} завершен после перезапуска")
+            except Exception as e:
+                print(f"❌ Ошибка продолжения анализа {job['analysis_id']}: {e}")
+            finally:
+                model_registry.release(variant)
+    
+    print(f"⏩ Продолжаю прерванные анализы: {len(jobs)}")
+    threading.Thread(target=resume_all, name="resume-analyses", daemon=True).start()
+
+def demo_statistics(filename: str):
+    """Тестовые данные для демонстрации, когда модель не загружена"""
+    return {
+        'video_info': {
+            'filename': filename,
+            'resolution': '1280x720',
+            'fps': 30,
+            'total_frames': 450,
+            'duration_seconds': 15.0
+        },
+        'detections': {
+            'total_frames_with_detections': 45,
+            'total_objects_detected': 127,
+            'by_class': {
+                'Скейтбордист': {'count': 23, 'avg_confidence': 0.85},
+                'Пешеход': {'count': 89, 'avg_confidence': 0.72},
+                'Велосипедист': {'count': 15, 'avg_confidence': 0.68}
+            },
+            'frames_with_violations': [
+                {'frame': 45, 'timestamp': 1.5, 'confidence': 0.89},
+                {'frame': 120, 'timestamp': 4.0, 'confidence': 0.91},
+                {'frame': 210, 'timestamp': 7.0, 'confidence': 0.76},
+                {'frame': 285, 'timestamp': 9.5, 'confidence': 0.82},
+                {'frame': 360, 'timestamp': 12.0, 'confidence': 0.71}
+            ]
+        },
+        'summary': {
+            'violation_percentage': 11.1,
+            'avg_objects_per_frame': 2.8,
+            'most_common_class': 'Пешеход'
+        }
+    }
+
+def analysis_response(job: dict) -> dict:
+    """Ответ загрузки по завершенному анализу"""
+    report_id = job['result']['report_id']
+    return {
+        "status": "success",
+        "message": "Видео успешно обработано",
+        "analysis_id": job['analysis_id'],
+        "report_id": report_id,
+        "statistics": job['result']['statistics'],
+        "pdf_url": f"/api/download-report/{report_id}"
+    }
+
 @app.post("/api/upload-video/")
-async def upload_video(file: UploadFile = File(...)):
-    """Загрузка и обработка видео"""
+async def upload_video(file: UploadFile = File(...), camera: Optional[str] = Form(None),
+                       model_name: Optional[str] = Form(None), tiling: Optional[str] = Form(None),
+                       analysis_id: Optional[str] = Form(None), recorded_at: Optional[str] = Form(None)):
+    """Загрузка и обработка видео
+    
+    analysis_id можно задать на клиенте: если запрос оборвется, результат продолжённого
+    после перезапуска анализа доступен по /api/analyses/{analysis_id}, а повторная
+    загрузка с тем же id не запускает анализ заново.
+    """
+    variant = None
+    upload_path = None
+    job = None
     try:
         print(f"📥 Получен файл: {file.filename}")
+        if analysis_id:
+            try:
+                analysis_id = str(uuid.UUID(analysis_id))
+            except ValueError:
+                raise HTTPException(status_code=400, detail="analysis_id должен быть UUID")
+            
+            existing = load_job(analysis_id)
+            if existing is not None and existing['status'] == 'done':
+                return analysis_response(existing)
+            if existing is not None and existing['status'] == 'running':
+                return JSONResponse(status_code=202, content={
+                    "status": "running",
+                    "message": "Анализ уже выполняется",
+                    "analysis_id": analysis_id
+                })
+        else:
+            analysis_id = str(uuid.uuid4())
         
         # Проверяем тип файла
         allowed_extensions = {'.mp4', '.avi', '.mov', '.mkv', '.webm'}
@@ -372,193 +1525,201 @@ async def upload_video(file: UploadFile = File(...)):
                 detail=f"Неподдерживаемый формат файла. Поддерживаются: {', '.join(allowed_extensions)}"
             )
         
-        # Сохраняем файл во временную папку
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
-            content = await file.read()
-            tmp_file.write(content)
-            tmp_path = tmp_file.name
+        # Начало записи (ISO 8601) - основа времени детекций в аналитике
+        recorded_start = None
+        if recorded_at:
+            try:
+                recorded_start = datetime.fromisoformat(recorded_at)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="recorded_at должен быть в формате ISO 8601")
+            if recorded_start.tzinfo is not None:
+                recorded_start = recorded_start.astimezone().replace(tzinfo=None)
         
-        print(f"💾 Файл сохранен временно: {tmp_path} ({len(content)} байт)")
+        if tiling is not None and tiling not in TILING_MODES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Неизвестный режим плиток. Доступны: {', '.join(TILING_MODES)}"
+            )
         
-        # Если модель загружена, обрабатываем видео
-        if model is not None:
-            print("🔍 Начинаю обработку видео с моделью...")
-            
-            # Простая обработка для демо (анализируем первые 5 секунд)
-            cap = cv2.VideoCapture(tmp_path)
-            fps = int(cap.get(cv2.CAP_PROP_FPS)) or 30
-            total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) or 1280
-            height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) or 720
-            
-            # Анализируем только первые 5 секунд для скорости
-            frames_to_analyze = min(fps * 5, total_frames) if total_frames > 0 else 150
-            violations = []
-            total_detections = 0
-            by_class = {}
-            
-            print(f"📊 Анализирую {frames_to_analyze} кадров...")
-            
-            for i in range(frames_to_analyze):
-                ret, frame = cap.read()
-                if not ret:
-                    break
-                
-                # Анализируем каждый 5-й кадр для скорости
-                if i % 5 == 0:
-                    results = model(frame, conf=0.3, verbose=False)
-                    
-                    if results[0].boxes is not None:
-                        total_detections += 1
-                        
-                        for box in results[0].boxes:
-                            class_id = int(box.cls[0])
-                            class_name = model.names.get(class_id, f"class_{class_id}")
-                            confidence = float(box.conf[0])
-                            
-                            # Обновляем статистику по классам
-                            if class_name not in by_class:
-                                by_class[class_name] = {'count': 0, 'confidences': []}
-                            
-                            by_class[class_name]['count'] += 1
-                            by_class[class_name]['confidences'].append(confidence)
-                            
-                            # Если скейтбордист - отмечаем как нарушение
-                            if class_name.lower() in ['skateboarder', 'skateboard', 'person']:
-                                violations.append({
-                                    'frame': i,
-                                    'timestamp': i / fps,
-                                    'confidence': confidence
-                                })
-            
-            cap.release()
-            
-            # Рассчитываем среднюю уверенность для каждого класса
-            for class_name in by_class:
-                confidences = by_class[class_name]['confidences']
-                by_class[class_name]['avg_confidence'] = sum(confidences) / len(confidences) if confidences else 0
-            
-            # Формируем статистику
-            statistics = {
-                'video_info': {
-                    'filename': file.filename,
-                    'resolution': f"{width}x{height}",
-                    'fps': fps,
-                    'total_frames': total_frames,
-                    'duration_seconds': total_frames / fps if fps > 0 else 0
-                },
-                'detections': {
-                    'total_frames_with_detections': total_detections,
-                    'total_objects_detected': sum(stats['count'] for stats in by_class.values()),
-                    'by_class': by_class,
-                    'frames_with_violations': violations[:50]  # Ограничиваем список
-                },
-                'summary': {
-                    'violation_percentage': (len(violations) / max(1, frames_to_analyze // 5)) * 100,
-                    'avg_objects_per_frame': sum(stats['count'] for stats in by_class.values()) / max(1, frames_to_analyze // 5),
-                    'most_common_class': max(by_class.items(), key=lambda x: x[1]['count'])[0] if by_class else 'Не обнаружено'
-                }
-            }
-            
-        else:
-            print("⚠️  Модель не загружена, использую тестовые данные")
-            # Тестовые данные для демонстрации
-            statistics = {
-                'video_info': {
-                    'filename': file.filename,
-                    'resolution': '1280x720',
-                    'fps': 30,
-                    'total_frames': 450,
-                    'duration_seconds': 15.0
-                },
-                'detections': {
-                    'total_frames_with_detections': 45,
-                    'total_objects_detected': 127,
-                    'by_class': {
-                        'Скейтбордист': {'count': 23, 'avg_confidence': 0.85},
-                        'Пешеход': {'count': 89, 'avg_confidence': 0.72},
-                        'Велосипедист': {'count': 15, 'avg_confidence': 0.68}
-                    },
-                    'frames_with_violations': [
-                        {'frame': 45, 'timestamp': 1.5, 'confidence': 0.89},
-                        {'frame': 120, 'timestamp': 4.0, 'confidence': 0.91},
-                        {'frame': 210, 'timestamp': 7.0, 'confidence': 0.76},
-                        {'frame': 285, 'timestamp': 9.5, 'confidence': 0.82},
-                        {'frame': 360, 'timestamp': 12.0, 'confidence': 0.71}
-                    ]
-                },
-                'summary': {
-                    'violation_percentage': 11.1,
-                    'avg_objects_per_frame': 2.8,
-                    'most_common_class': 'Пешеход'
-                }
-            }
+        # Выбираем вариант модели: явно указанный или по текущей нагрузке
+        try:
+            variant = model_registry.acquire(model_name)
+        except KeyError:
+            raise HTTPException(status_code=400, detail=f"Неизвестная модель: {model_name}")
         
-        # Генерируем PDF отчет
-        report_id = str(uuid.uuid4())
-        pdf_path = os.path.join(REPORTS_DIR, f"report_{report_id}.pdf")
+        # Явно выбранный вариант, который не загрузился, сам по себе не появится - это не 503
+        if variant is None and model_name and not model_registry.is_loading(model_name) \
+                and model_name in model_state['errors']:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Модель {model_name} не загружена: {model_state['errors'][model_name]}"
+            )
         
-        generate_pdf_with_russian(statistics, pdf_path)
+        # Пока модель грузится, не подменяем результат тестовыми данными
+        # model_state 'loading' покрывает и импорт torch/ultralytics, когда ни один вариант еще не грузится
+        if variant is None and (model_name or model_state['status'] == 'loading' or model_registry.is_loading()):
+            raise HTTPException(status_code=503, detail="Модель еще загружается, повторите позже")
         
-        # Сохраняем в историю
-        save_to_history({
-            'filename': file.filename,
-            'violations_count': len(statistics['detections']['frames_with_violations']),
-            'total_objects': statistics['detections']['total_objects_detected']
-        })
+        # Сохраняем файл в папку загрузок: из нее анализ продолжится после перезапуска
+        upload_path = os.path.join(UPLOAD_DIR, f"{analysis_id}{file_ext}")
+        with open(upload_path, 'wb') as upload_file:
+            content = await file.read()
+            upload_file.write(content)
         
-        # Удаляем временный файл
-        try:
-            os.unlink(tmp_path)
-        except:
-            pass
+        print(f"💾 Файл сохранен: {upload_path} ({len(content)} байт)")
+        
+        # Если модель загружена, обрабатываем видео (в пуле потоков, не блокируя другие запросы)
+        if variant is not None:
+            job = new_job(analysis_id, upload_path, file.filename, camera, variant['name'],
+                          tiling or TILING_MODE, recorded_start)
+            save_checkpoint(job)
+            await run_in_threadpool(run_analysis, job, variant)
+            return analysis_response(job)
+        
+        print("⚠️  Модель не загружена, использую тестовые данные")
+        statistics = demo_statistics(file.filename)
+        statistics['model'] = None
+        report_id = str(uuid.uuid4())
+        finish_analysis(None, statistics, report_id, None, analysis_id)
         
         return {
             "status": "success",
             "message": "Видео успешно обработано",
+            "analysis_id": analysis_id,
             "report_id": report_id,
             "statistics": statistics,
             "pdf_url": f"/api/download-report/{report_id}"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Ошибка: {str(e)}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if variant is not None:
+            model_registry.release(variant)
+        
+        # Загрузку храним только пока анализ не завершен
+        if upload_path and job is None:
+            try:
+                os.unlink(upload_path)
+            except:
+                pass
 
-@app.get("/api/download-report/{report_id}")
-async def download_report(report_id: str):
-    """Скачивание отчета"""
-    pdf_path = os.path.join(REPORTS_DIR, f"report_{report_id}.pdf")
-    txt_path = os.path.join(REPORTS_DIR, f"report_{report_id}.txt")
+@app.get("/api/analyses/{analysis_id}")
+async def get_analysis(analysis_id: str):
+    """Состояние анализа: прогресс по контрольной точке или готовый результат"""
+    job = load_job(analysis_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Анализ не найден")
     
-    if os.path.exists(pdf_path):
-        return FileResponse(
-            path=pdf_path,
-            filename=f"skateboard_report_{report_id}.pdf",
-            media_type='application/pdf'
-        )
-    elif os.path.exists(txt_path):
-        return FileResponse(
-            path=txt_path,
-            filename=f"skateboard_report_{report_id}.txt",
-            media_type='text/plain'
-        )
-    else:
+    video = job.get('video') or {}
+    return {
+        "analysis_id": analysis_id,
+        "status": job['status'],
+        "model": job['model_name'],
+        "next_frame": job['next_frame'],
+        "frames_to_analyze": video.get('frames_to_analyze'),
+        "error": job['error'],
+        "report_id": job['report_id'] if job['status'] == 'done' else None,
+        "result": job['result']
+    }
+
+@app.get("/api/download-report/{report_id}")
+async def download_report(report_id: str, request: Request):
+    """Скачивание отчета (поддерживает условные запросы и Range)"""
+    entry = report_store.get(report_id)
+    if entry is None:
         raise HTTPException(status_code=404, detail="Отчет не найден")
+    
+    # Отчеты не меняются после создания - кешируем на клиенте и в прокси
+    headers = {
+        'etag': entry['etag'],
+        'last-modified': entry['last_modified'],
+        'cache-control': f"public, max-age={REPORTS_CACHE_MAX_AGE}"
+    }
+    
+    if is_not_modified(request, entry):
+        return Response(status_code=304, headers=headers)
+    
+    # FileResponse сам обрабатывает Range / If-Range; stat берем из индекса
+    return FileResponse(
+        path=entry['path'],
+        filename=f"skateboard_report_{report_id}{entry['ext']}",
+        media_type=entry['media_type'],
+        headers=headers,
+        stat_result=entry['stat']
+    )
 
 @app.get("/api/history/")
-async def get_history():
-    """Получение истории обработок"""
-    if os.path.exists(HISTORY_FILE):
-        try:
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-            return {"history": history}
-        except:
-            return {"history": []}
-    return {"history": []}
+async def get_history(page: Optional[int] = None, page_size: int = 20,
+                      sort_by: str = "timestamp", order: str = "desc"):
+    """Получение истории обработок (без page - вся история)"""
+    history = load_history()
+    if page is None:
+        return {"history": history}
+    
+    if sort_by not in HISTORY_SORT_FIELDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Недопустимая сортировка. Доступны: {', '.join(HISTORY_SORT_FIELDS)}"
+        )
+    if order not in ('asc', 'desc'):
+        raise HTTPException(status_code=400, detail="order должен быть asc или desc")
+    if page < 1 or not 1 <= page_size <= 500:
+        raise HTTPException(status_code=400, detail="Неверные параметры страницы")
+    
+    # None (старые записи без поля) всегда в конце
+    present = [item for item in history if item.get(sort_by) is not None]
+    missing = [item for item in history if item.get(sort_by) is None]
+    present.sort(key=lambda item: item[sort_by], reverse=(order == "desc"))
+    history_sorted = present + missing
+    
+    total_violations = sum(item.get('violations_count', 0) for item in history)
+    start = (page - 1) * page_size
+    return {
+        "history": history_sorted[start:start + page_size],
+        "total": len(history),
+        "page": page,
+        "page_size": page_size,
+        "summary": {
+            "total_violations": total_violations,
+            "avg_violations": total_violations / len(history) if history else 0
+        }
+    }
+
+@app.delete("/api/history/")
+async def clear_history():
+    """Очистка истории обработок"""
+    with history_lock:
+        removed = len(load_history())
+        if os.path.exists(HISTORY_FILE):
+            os.remove(HISTORY_FILE)
+    return {"status": "success", "removed": removed}
+
+@app.get("/api/analytics/")
+def get_analytics(group_by: str = "hour", date_from: Optional[str] = None, date_to: Optional[str] = None,
+                  camera: Optional[str] = None, class_name: Optional[str] = None,
+                  violations_only: bool = False):
+    """Агрегаты по архиву детекций, например group_by=date,hour"""
+    keys = [key.strip() for key in group_by.split(',') if key.strip()]
+    unknown = [key for key in keys if key not in ANALYTICS_GROUP_BY]
+    if not keys or unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Недопустимая группировка. Доступны: {', '.join(ANALYTICS_GROUP_BY)}"
+        )
+    
+    try:
+        rows = query_detections(keys, date_from, date_to, camera, class_name, violations_only)
+    except Exception as e:
+        print(f"❌ Ошибка аналитики: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    return {"group_by": keys, "rows": rows}
 
 @app.get("/api/test-connection/")
 async def test_connection():
@@ -566,10 +1727,64 @@ async def test_connection():
     return {
         "status": "success",
         "message": "API работает",
-        "model_loaded": model is not None,
-        "model_classes": model.names if model else None,
+        "model_loaded": bool(model_registry.ready()),
+        "model_status": model_state['status'],
+        "model_classes": model_registry.classes(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.get("/api/models/")
+async def list_models():
+    """Варианты модели и текущая очередь запросов"""
+    return {"variants": model_registry.describe(), "queue_depth": model_registry.inflight}
+
+@app.post("/api/models/{name}/reload", status_code=202)
+async def reload_model(name: str, path: Optional[str] = Form(None)):
+    """Горячая замена варианта модели (новые веса грузятся в фоне)"""
+    # Веса загружаются через unpickle - только варианты из models.json и файлы из WEIGHTS_DIR
+    if name not in model_registry.variants:
+        raise HTTPException(status_code=400, detail=f"Неизвестная модель: {name}")
+    if path:
+        weights_dir = os.path.realpath(WEIGHTS_DIR)
+        real_path = os.path.realpath(path)
+        if os.path.commonpath([weights_dir, real_path]) != weights_dir or Path(real_path).suffix != '.pt':
+            raise HTTPException(status_code=400, detail=f"Веса должны быть .pt файлом внутри {WEIGHTS_DIR}")
+        if not os.path.isfile(real_path):
+            raise HTTPException(status_code=400, detail=f"Файл весов не найден: {path}")
+        path = real_path
+    if model_registry.is_loading(name):
+        raise HTTPException(status_code=409, detail=f"Модель {name} уже загружается")
+    
+    def reload():
+        try:
+            model_registry.load(name, path)
+            model_state['status'] = 'ready'
+            model_state['errors'].pop(name, None)
+        except Exception as e:
+            print(f"❌ Ошибка перезагрузки модели {name}: {e}")
+            model_state['errors'][name] = str(e)
+    
+    threading.Thread(target=reload, name=f"model-reload-{name}", daemon=True).start()
+    return {"status": "loading", "name": name}
+
+@app.get("/api/health/live")
+async def health_live():
+    """Liveness: процесс запущен и обслуживает запросы"""
+    return {"status": "alive", "timestamp": datetime.now().isoformat()}
+
+@app.get("/api/health/ready")
+async def health_ready():
+    """Readiness: модель загружена и прогрета"""
+    body = {
+        "status": model_state['status'],
+        "errors": model_state['errors'],
+        "models": model_registry.describe(),
+        "timings": model_state['timings'],
         "timestamp": datetime.now().isoformat()
     }
+    if model_state['status'] != 'ready':
+        return JSONResponse(status_code=503, content=body)
+    return body
 
 @app.get("/")
 async def root():
@@ -582,6 +1797,8 @@ if __name__ == "__main__":
     print("=" * 60)
     print(f"📁 Папка загрузок: {os.path.abspath(UPLOAD_DIR)}")
     print(f"📁 Папка отчетов: {os.path.abspath(REPORTS_DIR)}")
+    print(f"📁 Архив детекций: {os.path.abspath(DETECTIONS_DIR)}")
+    print(f"📁 Контрольные точки: {os.path.abspath(CHECKPOINTS_DIR)}")
     print(f"🌐 API доступен по адресу: http://localhost:8000")
     print("=" * 60)
     
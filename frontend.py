@@ -1,35 +1,78 @@
 # frontend_fixed.py
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 from datetime import datetime
 import time
 import json
+import uuid
 
 # Конфигурация
 BACKEND_URL = "http://localhost:8000"
+STATUS_TTL = 15  # секунд кеша статуса бекенда
+MODELS_TTL = 60  # секунд кеша списка моделей
+HISTORY_PAGE_SIZE = 20
 st.set_page_config(
     page_title="Контроль катания на скейтборде",
     page_icon="🛹",
     layout="wide"
 )
 
+@st.cache_resource
+def get_session():
+    """Общая сессия с пулом соединений для всех перезапусков скрипта"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_data(ttl=STATUS_TTL, show_spinner=False)
+def fetch_status():
+    """Статус бекенда и модели (None - бекенд недоступен)"""
+    try:
+        response = get_session().get(f"{BACKEND_URL}/api/test-connection/", timeout=5)
+        return response.json() if response.status_code == 200 else None
+    except:
+        return None
+
+@st.cache_data(ttl=STATUS_TTL, show_spinner=False)
+def fetch_history_page(page: int, sort_by: str, order: str):
+    """Страница истории с сортировкой на сервере"""
+    response = get_session().get(
+        f"{BACKEND_URL}/api/history/",
+        params={"page": page, "page_size": HISTORY_PAGE_SIZE, "sort_by": sort_by, "order": order},
+        timeout=10
+    )
+    response.raise_for_status()
+    return response.json()
+
+@st.cache_data(ttl=MODELS_TTL, show_spinner=False)
+def fetch_models():
+    """Варианты модели на бекенде"""
+    try:
+        response = get_session().get(f"{BACKEND_URL}/api/models/", timeout=5)
+        return response.json().get('variants', []) if response.status_code == 200 else []
+    except:
+        return []
+
+session = get_session()
+
 st.title("🛹 Контроль катания на скейтборде")
 st.markdown("---")
 
 # Проверка подключения к бекенду
-try:
-    response = requests.get(f"{BACKEND_URL}/api/test-connection/", timeout=5)
-    if response.status_code == 200:
-        st.success("✅ Подключено к бекенду")
-        data = response.json()
-        if data.get('model_loaded'):
-            st.info(f"🤖 Модель загружена. Классы: {data.get('model_classes')}")
-        else:
-            st.warning("⚠️ Модель не загружена")
+status = fetch_status()
+if status is not None:
+    st.success("✅ Подключено к бекенду")
+    if status.get('model_loaded'):
+        st.info(f"🤖 Модель загружена. Классы: {status.get('model_classes')}")
+    elif status.get('model_status') == 'loading':
+        st.info("⏳ Модель загружается...")
     else:
-        st.error("❌ Бекенд недоступен")
-except:
+        st.warning("⚠️ Модель не загружена")
+else:
     st.error("❌ Не удалось подключиться к бекенду")
     st.info("Запустите бекенд: `python backend.py`")
 
@@ -42,6 +85,23 @@ uploaded_file = st.file_uploader(
     type=['mp4', 'avi', 'mov', 'mkv'],
     help="Максимальный размер: 100 MB"
 )
+camera = st.text_input("Камера", value="default", help="Идентификатор камеры для аналитики")
+recorded_at = st.text_input(
+    "Начало записи",
+    value="",
+    placeholder="2026-10-01T10:00:00",
+    help="Время начала записи (ISO 8601). Пусто - время обработки"
+)
+
+# Варианты модели: "Авто" - сервер выбирает по текущей нагрузке
+model_options = ["Авто"] + [v['name'] for v in fetch_models() if v['status'] == 'ready']
+model_choice = st.selectbox("Модель", model_options)
+tiling_options = {"Авто": "auto", "Всегда": "always", "Выключен": "off"}
+tiling_choice = st.selectbox(
+    "Плиточный режим",
+    list(tiling_options.keys()),
+    help="Разбиение кадров высокого разрешения на плитки для поиска мелких дальних объектов"
+)
 
 if uploaded_file:
     st.info(f"📁 Выбран файл: **{uploaded_file.name}** ({uploaded_file.size / 1024 / 1024:.1f} MB)")
@@ -56,7 +116,15 @@ if uploaded_file:
             status_text.text("📤 Загружаю видео на сервер...")
             
             files = {"file": (uploaded_file.name, uploaded_file, uploaded_file.type)}
-            response = requests.post(f"{BACKEND_URL}/api/upload-video/", files=files)
+            # id задаем сами: если запрос оборвется, результат можно будет найти по нему
+            analysis_id = str(uuid.uuid4())
+            st.session_state['last_analysis_id'] = analysis_id
+            data = {"camera": camera, "tiling": tiling_options[tiling_choice], "analysis_id": analysis_id}
+            if recorded_at.strip():
+                data["recorded_at"] = recorded_at.strip()
+            if model_choice != "Авто":
+                data["model_name"] = model_choice
+            response = session.post(f"{BACKEND_URL}/api/upload-video/", files=files, data=data)
             
             progress_bar.progress(30)
             status_text.text("🔍 Анализирую видео...")
@@ -68,9 +136,14 @@ if uploaded_file:
                 
                 # Показываем результаты
                 st.success("✅ Видео успешно обработано!")
+                fetch_history_page.clear()
                 
                 # Статистика
                 stats = result['statistics']
+                if stats.get('model'):
+                    st.caption(f"🤖 Модель: {stats['model']['name']} ({stats['model']['path']})")
+                if stats.get('inference', {}).get('tiled_frames'):
+                    st.caption(f"🧩 Кадров с плиточным инференсом: {stats['inference']['tiled_frames']}")
                 
                 col1, col2, col3, col4 = st.columns(4)
                 
@@ -134,7 +207,7 @@ if uploaded_file:
                 # Альтернативный способ скачивания
                 if st.button("💾 Сохранить отчет локально", type="secondary"):
                     try:
-                        pdf_response = requests.get(pdf_url)
+                        pdf_response = session.get(pdf_url)
                         if pdf_response.status_code == 200:
                             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
                             filename = f"skateboard_report_{timestamp}.pdf"
@@ -164,66 +237,155 @@ if uploaded_file:
                 with st.expander("📊 Показать полные данные"):
                     st.json(result)
                 
+            elif response.status_code == 202:
+                st.info(f"⏳ Анализ уже выполняется, id: `{analysis_id}`")
             else:
                 st.error(f"❌ Ошибка обработки: {response.text}")
                 
         except Exception as e:
             st.error(f"❌ Ошибка: {str(e)}")
+            st.info(f"Если бекенд перезапустился, анализ продолжится. Id анализа: `{analysis_id}`")
             import traceback
             st.code(traceback.format_exc())
 
+# Проверка анализа, запрос которого оборвался
+if st.session_state.get('last_analysis_id'):
+    if st.button("🔎 Проверить последний анализ", type="secondary"):
+        last_id = st.session_state['last_analysis_id']
+        try:
+            response = session.get(f"{BACKEND_URL}/api/analyses/{last_id}", timeout=10)
+            if response.status_code == 200:
+                job = response.json()
+                if job['status'] == 'done':
+                    st.success("✅ Анализ завершен")
+                    st.markdown(f"[📥 Скачать PDF отчет]({BACKEND_URL}/api/download-report/{job['report_id']})")
+                elif job['status'] == 'running':
+                    st.info(f"⏳ Обработано кадров: {job['next_frame']} из {job['frames_to_analyze'] or '?'}")
+                else:
+                    st.error(f"❌ Анализ завершился ошибкой: {job['error']}")
+            else:
+                st.warning("Анализ не найден")
+        except Exception as e:
+            st.error(f"❌ Ошибка подключения: {e}")
+
 # История обработок
 st.markdown("---")
 if st.button("📜 Показать историю обработок", type="secondary"):
+    st.session_state['show_history'] = not st.session_state.get('show_history', False)
+
+if st.session_state.get('show_history'):
+    sort_options = {
+        "Дата": "timestamp",
+        "Файл": "filename",
+        "Нарушения": "violations_count",
+        "Объекты": "total_objects",
+        "Модель": "model"
+    }
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        sort_label = st.selectbox("Сортировка", list(sort_options.keys()))
+    with col2:
+        order = st.radio("Порядок", ["desc", "asc"], horizontal=True,
+                         format_func=lambda x: "По убыванию" if x == "desc" else "По возрастанию")
+    with col3:
+        page = st.number_input("Страница", min_value=1, value=1, step=1)
+    
     try:
-        response = requests.get(f"{BACKEND_URL}/api/history/")
-        if response.status_code == 200:
-            history = response.json().get('history', [])
+        data = fetch_history_page(int(page), sort_options[sort_label], order)
+        history = data.get('history', [])
+        
+        if data.get('total'):
+            st.subheader("История обработок")
             
             if history:
-                st.subheader("История обработок")
-                
-                # Конвертируем в DataFrame
+                # Сервер отдает только текущую страницу
                 df = pd.DataFrame(history)
-                df['timestamp'] = pd.to_datetime(df['timestamp'])
-                df['Дата'] = df['timestamp'].dt.strftime('%Y-%m-%d %H:%M')
-                
-                # Конвертируем числовые колонки
-                numeric_cols = ['violations_count', 'total_objects']
-                for col in numeric_cols:
-                    if col in df.columns:
-                        df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0).astype(int)
+                df['Дата'] = pd.to_datetime(df['timestamp']).dt.strftime('%Y-%m-%d %H:%M')
+                for col in ('model', 'report_id'):
+                    if col not in df.columns:
+                        df[col] = None
+                df['Отчет'] = df['report_id'].apply(
+                    lambda rid: f"{BACKEND_URL}/api/download-report/{rid}" if rid else None
+                )
                 
-                # Показываем таблицу
                 st.dataframe(
-                    df[['Дата', 'filename', 'violations_count', 'total_objects']],
-                    width='stretch'  # Исправлено
+                    df[['Дата', 'filename', 'model', 'violations_count', 'total_objects', 'Отчет']],
+                    width='stretch',
+                    column_config={'Отчет': st.column_config.LinkColumn('Отчет', display_text='📥 PDF')}
                 )
-                
-                # Простая статистика
-                if len(df) > 0:
-                    st.write(f"**Всего обработок:** {len(df)}")
-                    st.write(f"**Всего нарушений:** {df['violations_count'].sum()}")
-                    st.write(f"**Среднее нарушений на видео:** {df['violations_count'].mean():.1f}")
-            else:
-                st.info("История обработок пуста")
+            
+            pages = (data['total'] + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+            st.caption(f"Страница {data['page']} из {pages}")
+            
+            # Сводка считается на сервере по всей истории
+            summary = data.get('summary', {})
+            st.write(f"**Всего обработок:** {data['total']}")
+            st.write(f"**Всего нарушений:** {summary.get('total_violations', 0)}")
+            st.write(f"**Среднее нарушений на видео:** {summary.get('avg_violations', 0):.1f}")
+        else:
+            st.info("История обработок пуста")
     except Exception as e:
         st.error(f"Не удалось загрузить историю: {e}")
 
+# Аналитика по архиву детекций
+st.markdown("---")
+st.header("📈 Аналитика детекций")
+
+group_options = {
+    "По часам": "hour",
+    "По дням": "date",
+    "По дням недели": "weekday",
+    "По камерам": "camera",
+    "По классам": "class_name",
+    "По файлам": "source"
+}
+
+col1, col2, col3 = st.columns(3)
+with col1:
+    group_label = st.selectbox("Группировка", list(group_options.keys()))
+with col2:
+    date_range = st.date_input("Период", value=[], help="Пустой период - весь архив")
+with col3:
+    analytics_camera = st.text_input("Камера (фильтр)", value="")
+    violations_only = st.checkbox("Только нарушения", value=True)
+
+if st.button("📊 Построить", type="secondary"):
+    params = {"group_by": group_options[group_label], "violations_only": violations_only}
+    if len(date_range) == 2:
+        params["date_from"] = date_range[0].isoformat()
+        params["date_to"] = date_range[1].isoformat()
+    if analytics_camera:
+        params["camera"] = analytics_camera
+    
+    try:
+        response = session.get(f"{BACKEND_URL}/api/analytics/", params=params, timeout=30)
+        if response.status_code == 200:
+            rows = response.json().get('rows', [])
+            if rows:
+                # Сервер возвращает уже агрегированные строки
+                df = pd.DataFrame(rows).set_index(params["group_by"])
+                metric = 'violations' if violations_only else 'detections'
+                st.bar_chart(df[metric])
+                st.dataframe(df, width='stretch')
+            else:
+                st.info("В архиве нет детекций за выбранный период")
+        else:
+            st.error(f"❌ Ошибка аналитики: {response.text}")
+    except Exception as e:
+        st.error(f"Не удалось загрузить аналитику: {e}")
+
 # Информация о системе
 with st.expander("ℹ️ Информация о системе"):
     st.write(f"**Бекенд:** {BACKEND_URL}")
     st.write(f"**Текущее время:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     
-    try:
-        test_resp = requests.get(f"{BACKEND_URL}/api/test-connection/")
-        if test_resp.status_code == 200:
-            data = test_resp.json()
-            st.write("**Статус API:** ✅ Работает")
-            st.write(f"**Модель загружена:** {'✅ Да' if data.get('model_loaded') else '❌ Нет'}")
-            if data.get('model_classes'):
-                st.write(f"**Классы модели:** {data.get('model_classes')}")
-    except:
+    # Тот же кешированный статус, что и в шапке страницы
+    if status is not None:
+        st.write("**Статус API:** ✅ Работает")
+        st.write(f"**Модель загружена:** {'✅ Да' if status.get('model_loaded') else '❌ Нет'}")
+        if status.get('model_classes'):
+            st.write(f"**Классы модели:** {status.get('model_classes')}")
+    else:
         st.write("**Статус API:** ❌ Недоступен")
 
 # Простой тест загрузки файла
@@ -234,8 +396,9 @@ col1, col2 = st.columns(2)
 
 with col1:
     if st.button("🔄 Проверить подключение"):
+        fetch_status.clear()
         try:
-            response = requests.get(f"{BACKEND_URL}/", timeout=3)
+            response = session.get(f"{BACKEND_URL}/", timeout=3)
             if response.status_code == 200:
                 st.success(f"✅ API работает: {response.json()}")
             else:
@@ -246,11 +409,11 @@ with col1:
 with col2:
     if st.button("🗑️ Очистить историю"):
         try:
-            # Создаем простой эндпоинт для очистки
-            if os.path.exists("processing_history.json"):
-                os.remove("processing_history.json")
-                st.success("✅ История очищена")
+            response = session.delete(f"{BACKEND_URL}/api/history/", timeout=10)
+            if response.status_code == 200:
+                fetch_history_page.clear()
+                st.success(f"✅ История очищена (записей: {response.json().get('removed', 0)})")
             else:
-                st.info("Файл истории не найден")
+                st.error(f"❌ API вернул код: {response.status_code}")
         except Exception as e:
             st.error(f"❌ Ошибка: {e}")